@@ -0,0 +1,117 @@
+"""Benchmark for the miIO protocol routines.
+
+Compares the throughput (frames per second) of encrypting and decrypting
+payloads of typical sizes with and without the per-token cipher cache,
+and of building and parsing frames with Message and MessageCodec.
+
+Usage: python devtools/bench_protocol.py [--number N]
+"""
+import argparse
+import datetime
+import os
+import timeit
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from miio.protocol import HeaderTemplate, Message, MessageCodec, Utils
+
+PAYLOAD_SIZES = [100, 250, 500, 1000, 1500]
+
+
+def uncached_encrypt(plaintext: bytes, token: bytes) -> bytes:
+    """Encryption as done before caching the ciphers per token."""
+    Utils.verify_token(token)
+    key, iv = Utils.key_iv(token)
+    padder = padding.PKCS7(128).padder()
+    padded_plaintext = padder.update(plaintext) + padder.finalize()
+    cipher = Cipher(algorithms.AES(key), modes.CBC(iv),
+                    backend=default_backend())
+    encryptor = cipher.encryptor()
+    return encryptor.update(padded_plaintext) + encryptor.finalize()
+
+
+def uncached_decrypt(ciphertext: bytes, token: bytes) -> bytes:
+    """Decryption as done before caching the ciphers per token."""
+    Utils.verify_token(token)
+    key, iv = Utils.key_iv(token)
+    cipher = Cipher(algorithms.AES(key), modes.CBC(iv),
+                    backend=default_backend())
+    decryptor = cipher.decryptor()
+    padded_plaintext = decryptor.update(ciphertext) + decryptor.finalize()
+    unpadder = padding.PKCS7(128).unpadder()
+    return unpadder.update(padded_plaintext) + unpadder.finalize()
+
+
+def frames_per_second(func, number: int) -> float:
+    return number / min(timeit.repeat(func, number=number, repeat=3))
+
+
+def bench_cipher_cache(token: bytes, number: int):
+    print("%8s %12s %12s %12s %12s" % ("size", "enc before", "enc after",
+                                       "dec before", "dec after"))
+    for size in PAYLOAD_SIZES:
+        payload = os.urandom(size)
+        ciphertext = Utils.encrypt(payload, token)
+
+        results = [
+            frames_per_second(lambda: uncached_encrypt(payload, token),
+                              number),
+            frames_per_second(lambda: Utils.encrypt(payload, token),
+                              number),
+            frames_per_second(lambda: uncached_decrypt(ciphertext, token),
+                              number),
+            frames_per_second(lambda: Utils.decrypt(ciphertext, token),
+                              number),
+        ]
+        print("%8s %12.0f %12.0f %12.0f %12.0f" % (size, *results))
+
+
+def bench_codec(token: bytes, number: int):
+    device_id = os.urandom(4)
+    ts = datetime.datetime.utcnow()
+    template = HeaderTemplate(device_id, token)
+    print("%8s %12s %12s %12s %12s %12s %12s" % (
+        "size", "msg build", "codec build", "tmpl build",
+        "msg parse", "codec parse", "lazy parse"))
+    for size in PAYLOAD_SIZES:
+        payload = {"id": 1, "result": ["x" * (size - 20)]}
+        msg = {'data': {'value': payload},
+               'header': {'value': {'length': 0, 'unknown': 0,
+                                    'device_id': device_id, 'ts': ts}},
+               'checksum': 0}
+        frame = Message.build(msg, token=token)
+
+        results = [
+            frames_per_second(lambda: Message.build(msg, token=token), number),
+            frames_per_second(
+                lambda: MessageCodec.build(device_id, ts, payload, token),
+                number),
+            frames_per_second(lambda: template.build(ts, payload), number),
+            frames_per_second(lambda: Message.parse(frame, token=token),
+                              number),
+            frames_per_second(lambda: MessageCodec.parse(frame, token),
+                              number),
+            frames_per_second(
+                lambda: MessageCodec.parse(frame, token, lazy=True).device_id,
+                number),
+        ]
+        print("%8s %12.0f %12.0f %12.0f %12.0f %12.0f %12.0f" % (size,
+                                                                 *results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000,
+                        help="frames per measurement")
+    args = parser.parse_args()
+
+    token = os.urandom(16)
+    bench_cipher_cache(token, args.number)
+    print()
+    bench_codec(token, args.number)
+
+
+if __name__ == "__main__":
+    main()
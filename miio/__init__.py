@@ -11,7 +11,7 @@ from miio.fan import Fan
 from miio.philips_bulb import PhilipsBulb
 from miio.philips_eyecare import PhilipsEyecare
 from miio.powerstrip import PowerStrip
-from miio.protocol import Message, Utils
+from miio.protocol import Message, MessageCodec, LazyMessage, Utils
 from miio.vacuum import Vacuum, VacuumException
 from miio.vacuumcontainers import (VacuumStatus, ConsumableStatus, DNDStatus,
                                    CleaningDetails, CleaningSummary, Timer, )
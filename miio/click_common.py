@@ -11,12 +11,12 @@ import click
 import ipaddress
 import miio
 import logging
-import json
 import re
 from typing import Union
 from functools import wraps
 from functools import partial
 from .exceptions import DeviceError
+from .protocol import get_json_backend
 
 
 _LOGGER = logging.getLogger(__name__)
@@ -260,19 +260,22 @@ def format_output(msg_fmt: Union[str, callable]= "",
 def json_output(pretty=False):
     indent = 2 if pretty else None
 
+    def dumps(obj):
+        return get_json_backend().dumps(obj, indent=indent).decode('utf-8')
+
     def decorator(func):
         @wraps(func)
         def wrap(*args, **kwargs):
             try:
                 result = func(*args, **kwargs)
             except DeviceError as ex:
-                click.echo(json.dumps(ex.args[0], indent=indent))
+                click.echo(dumps(ex.args[0]))
                 return
 
             get_json_data_func = getattr(result, '__json__', None)
             if get_json_data_func is not None:
                 result = get_json_data_func()
-            click.echo(json.dumps(result, indent=indent))
+            click.echo(dumps(result))
 
         return wrap
     return decorator
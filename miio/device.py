@@ -4,7 +4,8 @@ import datetime
 import logging
 import socket
 from enum import Enum
-from typing import Any, List, Optional  # noqa: F401
+from functools import partial
+from typing import Any, Dict, List, Optional  # noqa: F401
 
 import click
 import construct
@@ -13,10 +14,14 @@ from .click_common import (
     DeviceGroupMeta, command, format_output,
 )
 from .exceptions import DeviceException, DeviceError
-from .protocol import Message
+from .protocol import Message, MessageCodec, HeaderTemplate
 
 _LOGGER = logging.getLogger(__name__)
 
+# magic, length 32
+HELLO_BYTES = bytes.fromhex(
+    '21310020ffffffffffffffffffffffffffffffffffffffffffffffffffffffff')
+
 
 class UpdateState(Enum):
     Downloading = "downloading"
@@ -112,15 +117,21 @@ class Device(metaclass=DeviceGroupMeta):
     This is the main class providing the basic protocol handling for devices using
     the ``miIO`` protocol.
     This class should not be initialized directly but a device-specific class inheriting
-    it should be used instead of it."""
+    it should be used instead of it.
+
+    The device keeps a single connected UDP socket which is reused for all
+    messages, call :func:`close` or use the device as a context manager
+    to release it."""
     def __init__(self, ip: str = None, token: str = None,
-                 start_id: int=0, debug: int=0, lazy_discover: bool=True) -> None:
+                 start_id: int=0, debug: int=0, lazy_discover: bool=True,
+                 fast_codec: bool=False) -> None:
         """
         Create a :class:`Device` instance.
         :param ip: IP address or a hostname for the device
         :param token: Token used for encryption
         :param start_id: Running message id sent to the device
         :param debug: Wanted debug level
+        :param fast_codec: Use :class:`MessageCodec` instead of :data:`Message`
         """
         self.ip = ip
         self.port = 54321
@@ -130,12 +141,61 @@ class Device(metaclass=DeviceGroupMeta):
             self.token = bytes.fromhex(token)
         self.debug = debug
         self.lazy_discover = lazy_discover
+        self.fast_codec = fast_codec
 
         self._timeout = 5
         self._discovered = False
         self._device_ts = None  # type: datetime.datetime
         self.__id = start_id
         self._device_id = None
+        self._header_template = None  # type: Optional[HeaderTemplate]
+        self._socket = None  # type: Optional[socket.socket]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        """Close the socket used to communicate with the device.
+        A new one will be created when sending the next message."""
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _get_socket(self) -> socket.socket:
+        """Return the socket connected to the device, creating it if needed."""
+        if self._socket is None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                s.connect((self.ip, self.port))
+            except OSError:
+                s.close()
+                raise
+            self._socket = s
+        self._socket.settimeout(self._timeout)
+        return self._socket
+
+    def _hello(self) -> Any:
+        """Send a handshake over the device socket and return the response,
+        or None if the device does not respond."""
+        try:
+            s = self._get_socket()
+            s.send(HELLO_BYTES)
+            data = s.recv(1024)
+        except OSError as ex:
+            self.close()
+            _LOGGER.debug("Got error when doing a handshake: %s", ex)
+            return None
+
+        try:
+            if self.fast_codec:
+                return MessageCodec.parse(data, lazy=True)
+            return Message.parse(data)
+        except Exception as ex:
+            _LOGGER.warning("error while reading handshake response: %s", ex)
+            return None
 
     def do_discover(self) -> Message:
         """Send a handshake to the device,
@@ -146,7 +206,7 @@ class Device(metaclass=DeviceGroupMeta):
         :rtype: Message
 
         :raises DeviceException: if the device could not be discovered."""
-        m = Device.discover(self.ip)
+        m = self._hello()
         if m is not None:
             self._device_id = m.header.value.device_id
             self._device_ts = m.header.value.ts
@@ -164,14 +224,16 @@ class Device(metaclass=DeviceGroupMeta):
         return m
 
     @staticmethod
-    def discover(addr: str=None) -> Any:
+    def discover(addr: str=None, fast_codec: bool=False) -> Any:
         """Scan for devices in the network.
         This method is used to discover supported devices by sending a
         handshake message to the broadcast address on port 54321.
         If the target IP address is given, the handshake will be send as
         an unicast packet.
 
-        :param str addr: Target IP address"""
+        :param str addr: Target IP address
+        :param bool fast_codec: Parse the responses using :class:`MessageCodec`,
+                                without decrypting their payloads"""
         timeout = 5
         is_broadcast = addr is None
         seen_addrs = []  # type: List[str]
@@ -180,35 +242,36 @@ class Device(metaclass=DeviceGroupMeta):
             is_broadcast = True
             _LOGGER.info("Sending discovery to %s with timeout of %ss..",
                          addr, timeout)
-        # magic, length 32
-        helobytes = bytes.fromhex(
-            '21310020ffffffffffffffffffffffffffffffffffffffffffffffffffffffff')
-
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        s.settimeout(timeout)
-        s.sendto(helobytes, (addr, 54321))
-        while True:
-            try:
-                data, addr = s.recvfrom(1024)
-                m = Message.parse(data)  # type: Message
-                _LOGGER.debug("Got a response: %s", m)
-                if not is_broadcast:
-                    return m
-
-                if addr[0] not in seen_addrs:
-                    _LOGGER.info("  IP %s (ID: %s) - token: %s",
-                                 addr[0],
-                                 binascii.hexlify(m.header.value.device_id).decode(),
-                                 codecs.encode(m.checksum, 'hex'))
-                    seen_addrs.append(addr[0])
-            except socket.timeout:
-                if is_broadcast:
-                    _LOGGER.info("Discovery done")
-                return  # ignore timeouts on discover
-            except Exception as ex:
-                _LOGGER.warning("error while reading discover results: %s", ex)
-                break
+        if fast_codec:
+            parse = partial(MessageCodec.parse, lazy=True)
+        else:
+            parse = Message.parse
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            s.settimeout(timeout)
+            s.sendto(HELLO_BYTES, (addr, 54321))
+            while True:
+                try:
+                    data, addr = s.recvfrom(1024)
+                    m = parse(data)  # type: Message
+                    _LOGGER.debug("Got a response: %s", m)
+                    if not is_broadcast:
+                        return m
+
+                    if addr[0] not in seen_addrs:
+                        _LOGGER.info("  IP %s (ID: %s) - token: %s",
+                                     addr[0],
+                                     binascii.hexlify(m.header.value.device_id).decode(),
+                                     codecs.encode(m.checksum, 'hex'))
+                        seen_addrs.append(addr[0])
+                except socket.timeout:
+                    if is_broadcast:
+                        _LOGGER.info("Discovery done")
+                    return  # ignore timeouts on discover
+                except Exception as ex:
+                    _LOGGER.warning("error while reading discover results: %s", ex)
+                    break
 
     def send(self, command: str, parameters: Any=None, retry_count=3) -> Any:
         """Build and send the given command.
@@ -232,33 +295,26 @@ class Device(metaclass=DeviceGroupMeta):
             cmd["params"] = parameters
 
         send_ts = self._device_ts + datetime.timedelta(seconds=1)
-        header = {'length': 0, 'unknown': 0x00000000,
-                  'device_id': self._device_id, 'ts': send_ts}
-
-        msg = {'data': {'value': cmd},
-               'header': {'value': header},
-               'checksum': 0}
-        m = Message.build(msg, token=self.token)
+        m = self._build_message(cmd, send_ts)
         _LOGGER.debug("%s:%s >>: %s", self.ip, self.port, cmd)
         if self.debug > 1:
             _LOGGER.debug("send (timeout %s): %s",
-                          self._timeout, Message.parse(m, token=self.token))
-
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.settimeout(self._timeout)
+                          self._timeout, self._parse_message(m))
 
         try:
-            s.sendto(m, (self.ip, self.port))
+            s = self._get_socket()
+            s.send(m)
         except OSError as ex:
+            self.close()
             _LOGGER.error("failed to send msg: %s", ex)
             raise DeviceException from ex
 
         try:
-            data, addr = s.recvfrom(1024)
-            m = Message.parse(data, token=self.token)
+            data = s.recv(1024)
+            m = self._parse_message(data)
             self._device_ts = m.header.value.ts
             if self.debug > 1:
-                _LOGGER.debug("recv from %s: %s", addr[0], m)
+                _LOGGER.debug("recv from %s: %s", self.ip, m)
 
             self.__id = m.data.value["id"]
             _LOGGER.debug("%s:%s (ts: %s, id: %s) << %s",
@@ -278,6 +334,8 @@ class Device(metaclass=DeviceGroupMeta):
                                   "of an invalid token. "
                                   "Please check your token!") from ex
         except OSError as ex:
+            # drop the socket to get rid of any late replies
+            self.close()
             if retry_count > 0:
                 _LOGGER.debug("Retrying with incremented id, "
                               "retries left: %s", retry_count)
@@ -288,6 +346,31 @@ class Device(metaclass=DeviceGroupMeta):
             _LOGGER.error("Got error when receiving: %s", ex)
             raise DeviceException("No response from the device") from ex
 
+    def _build_message(self, cmd: Dict[str, Any], ts: datetime.datetime) -> bytes:
+        """Build an encrypted frame for the given command."""
+        if self.fast_codec:
+            template = self._header_template
+            if template is None or not template.matches(self._device_id,
+                                                        self.token):
+                template = HeaderTemplate(self._device_id, self.token)
+                self._header_template = template
+            return template.build(ts, cmd)
+
+        header = {'length': 0, 'unknown': 0x00000000,
+                  'device_id': self._device_id, 'ts': ts}
+
+        msg = {'data': {'value': cmd},
+               'header': {'value': header},
+               'checksum': 0}
+        return Message.build(msg, token=self.token)
+
+    def _parse_message(self, data: bytes) -> Any:
+        """Parse and decrypt a frame received from the device."""
+        if self.fast_codec:
+            return MessageCodec.parse(data, self.token)
+        return Message.parse(data, token=self.token,
+                             device_id=self._device_id)
+
     @command(
         click.argument('cmd', required=True),
         click.argument('parameters', required=False),
@@ -8,19 +8,30 @@ JSON objects, the same applies for decryption where they are converted
 automatically to JSON objects.
 If the decryption fails, raw bytes as returned by the device are returned.
 
+The JSON (de)serialization is done by the backend selected with
+:func:`set_json_backend`, or the ``MIIO_JSON_BACKEND`` environment variable.
+By default orjson or ujson is used when installed, falling back to the
+standard library json module.
+
 An usage example can be seen in the source of :func:`miio.Device.send`.
 """
 import calendar
 import datetime
+import functools
 import hashlib
 import json
 import logging
-from typing import Any, Dict, Tuple
+import os
+import struct
+import threading
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union  # noqa: F401
 
 import construct
 from construct import (Struct, Bytes, Const, Int16ub, Int32ub, GreedyBytes,
                        Adapter, Checksum, RawCopy, Rebuild, IfThenElse,
-                       Default, Pointer, Hex, )
+                       Default, Pointer, Hex, Container, )
+from construct.core import ChecksumError, ConstError, StreamError
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
@@ -30,6 +41,112 @@ _LOGGER = logging.getLogger(__name__)
 # needs to be maintained in sync with setup.py and requirements.txt
 assert construct.version_string == "2.9.41"
 
+# Number of tokens for which the derived key, iv and cipher are kept around.
+CIPHER_CACHE_SIZE = 128
+
+JSON_BACKEND_ENV = "MIIO_JSON_BACKEND"
+
+
+class JsonBackend:
+    """JSON serializer working directly on bytes, using the stdlib json."""
+    name = "json"
+
+    def dumps(self, obj: Any, indent: int = None) -> bytes:
+        """Serialize the given object to UTF-8 encoded JSON."""
+        return json.dumps(obj, indent=indent).encode('utf-8')
+
+    def loads(self, data: bytes) -> Any:
+        """Deserialize UTF-8 encoded JSON."""
+        return json.loads(data.decode('utf-8'))
+
+
+class OrjsonBackend(JsonBackend):
+    """JSON serializer using orjson.
+
+    The output is compact and non-ascii characters are not escaped."""
+    name = "orjson"
+
+    def __init__(self) -> None:
+        import orjson
+        self._orjson = orjson
+        self._options = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj: Any, indent: int = None) -> bytes:
+        if indent is None:
+            return self._orjson.dumps(obj, option=self._options)
+        if indent == 2:
+            return self._orjson.dumps(
+                obj, option=self._options | self._orjson.OPT_INDENT_2)
+        # orjson only knows how to indent by two spaces
+        return super().dumps(obj, indent=indent)
+
+    def loads(self, data: bytes) -> Any:
+        return self._orjson.loads(data)
+
+
+class UjsonBackend(JsonBackend):
+    """JSON serializer using ujson. The output is compact."""
+    name = "ujson"
+
+    def __init__(self) -> None:
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj: Any, indent: int = None) -> bytes:
+        return self._ujson.dumps(obj, indent=indent or 0,
+                                 escape_forward_slashes=False).encode('utf-8')
+
+    def loads(self, data: bytes) -> Any:
+        return self._ujson.loads(data)
+
+
+JSON_BACKENDS = OrderedDict([
+    ("orjson", OrjsonBackend),
+    ("ujson", UjsonBackend),
+    ("json", JsonBackend),
+])
+
+_json_backend = JsonBackend()  # type: JsonBackend
+
+
+def set_json_backend(name: str = None) -> JsonBackend:
+    """Select the JSON backend used for payloads and cli output.
+
+    :param str name: One of :data:`JSON_BACKENDS`,
+                     None to use the fastest installed one
+    :raises ValueError: if the backend is not known
+    :raises ImportError: if the backend is not installed
+    :return: Selected backend"""
+    global _json_backend
+    if name is None:
+        for backend_cls in JSON_BACKENDS.values():
+            try:
+                _json_backend = backend_cls()
+                break
+            except ImportError:
+                continue
+    elif name in JSON_BACKENDS:
+        _json_backend = JSON_BACKENDS[name]()
+    else:
+        raise ValueError("Unknown JSON backend '%s', available: %s" % (
+            name, ", ".join(JSON_BACKENDS)))
+
+    _LOGGER.debug("Using JSON backend %s", _json_backend.name)
+    return _json_backend
+
+
+def get_json_backend() -> JsonBackend:
+    """Return the JSON backend currently in use."""
+    return _json_backend
+
+
+try:
+    set_json_backend(os.environ.get(JSON_BACKEND_ENV) or None)
+except (ValueError, ImportError) as ex:
+    _LOGGER.warning("Unable to use JSON backend from %s: %s",
+                    JSON_BACKEND_ENV, ex)
+    set_json_backend()
+
 
 class Utils:
     """ This class is adapted from the original xpn.py code by gst666 """
@@ -56,6 +173,19 @@ class Utils:
         iv = Utils.md5(key + token)
         return key, iv
 
+    @staticmethod
+    @functools.lru_cache(maxsize=CIPHER_CACHE_SIZE)
+    def cipher(token: bytes) -> Cipher:
+        """Return a cipher for the given token.
+
+        The key and iv derivation is done only once per token, the returned
+        cipher is reused to create an encryptor or decryptor per message.
+        The results are kept in a bounded LRU cache,
+        use ``Utils.cipher.cache_clear()`` to drop them."""
+        key, iv = Utils.key_iv(token)
+        return Cipher(algorithms.AES(key), modes.CBC(iv),
+                      backend=default_backend())
+
     @staticmethod
     def encrypt(plaintext: bytes, token: bytes) -> bytes:
         """Encrypt plaintext with a given token.
@@ -66,14 +196,10 @@ class Utils:
         if not isinstance(plaintext, bytes):
             raise TypeError("plaintext requires bytes")
         Utils.verify_token(token)
-        key, iv = Utils.key_iv(token)
         padder = padding.PKCS7(128).padder()
 
         padded_plaintext = padder.update(plaintext) + padder.finalize()
-        cipher = Cipher(algorithms.AES(key), modes.CBC(iv),
-                        backend=default_backend())
-
-        encryptor = cipher.encryptor()
+        encryptor = Utils.cipher(token).encryptor()
         return encryptor.update(padded_plaintext) + encryptor.finalize()
 
     @staticmethod
@@ -86,11 +212,7 @@ class Utils:
         if not isinstance(ciphertext, bytes):
             raise TypeError("ciphertext requires bytes")
         Utils.verify_token(token)
-        key, iv = Utils.key_iv(token)
-        cipher = Cipher(algorithms.AES(key), modes.CBC(iv),
-                        backend=default_backend())
-
-        decryptor = cipher.decryptor()
+        decryptor = Utils.cipher(token).decryptor()
         padded_plaintext = decryptor.update(ciphertext) + decryptor.finalize()
 
         unpadder = padding.PKCS7(128).unpadder()
@@ -136,52 +258,136 @@ class TimeAdapter(Adapter):
         return datetime.datetime.utcfromtimestamp(obj)
 
 
+# list of adaption functions for malformed json payload (quirks)
+DECRYPTED_QUIRKS = [
+    # try without modifications first
+    ("none", lambda decrypted_bytes: decrypted_bytes),
+    # powerstrip returns malformed JSON if the device is not
+    # connected to the cloud, so we try to fix it here carefully.
+    ("otu_stat", lambda decrypted_bytes: decrypted_bytes.replace(b',,"otu_stat"', b',"otu_stat"')),
+    # xiaomi cloud returns malformed json when answering _sync.batch_gen_room_up_url
+    # command so try to sanitize it
+    ("trailing_garbage", lambda decrypted_bytes:
+        decrypted_bytes[:decrypted_bytes.rfind(b'\x00')]
+        if b'\x00' in decrypted_bytes
+        else decrypted_bytes),
+]  # type: List[Tuple[str, Callable[[bytes], bytes]]]
+
+
+class QuirkCache:
+    """Bounded table of the JSON quirk needed per device.
+
+    The quirk which last worked for a device is tried first on its next
+    payload, so devices needing a quirk do not pay for a failing parse
+    on every reply. Devices which do not need a quirk are not stored.
+    :attr:`stats` counts the payloads decoded per quirk name,
+    payloads which could not be decoded at all are counted as `failed`."""
+    def __init__(self, maxsize: int = 256) -> None:
+        self.maxsize = maxsize
+        self.stats = Counter()  # type: Counter
+        self._learned = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+        self._default_order = tuple(range(len(DECRYPTED_QUIRKS)))
+
+    def order(self, device_id: Optional[bytes]) -> Tuple[int, ...]:
+        """Return the indices of quirks in the order to try them."""
+        idx = self._learned.get(device_id)
+        if idx is None:
+            return self._default_order
+        return (idx, ) + tuple(i for i in self._default_order if i != idx)
+
+    def learn(self, device_id: Optional[bytes], idx: int) -> None:
+        """Record that the quirk at `idx` decoded a payload of the device."""
+        with self._lock:
+            self.stats[DECRYPTED_QUIRKS[idx][0]] += 1
+            if device_id is None:
+                return
+            if idx == 0:
+                self._learned.pop(device_id, None)
+                return
+            self._learned[device_id] = idx
+            self._learned.move_to_end(device_id)
+            while len(self._learned) > self.maxsize:
+                self._learned.popitem(last=False)
+
+    def failed(self) -> None:
+        """Record that no quirk could decode a payload."""
+        with self._lock:
+            self.stats["failed"] += 1
+
+    def quirk_for(self, device_id: bytes) -> str:
+        """Return the name of the quirk currently used for the device."""
+        return DECRYPTED_QUIRKS[self.order(device_id)[0]][0]
+
+    def clear(self) -> None:
+        """Forget all learned quirks and reset the statistics."""
+        with self._lock:
+            self._learned.clear()
+            self.stats.clear()
+
+    def __len__(self):
+        return len(self._learned)
+
+
 class EncryptionAdapter(Adapter):
-    """Adapter to handle communication encryption."""
+    """Adapter to handle communication encryption.
+
+    The device id, if passed to :func:`Message.parse` alongside the token,
+    is used to look up the JSON quirk the device needs from :attr:`quirk_cache`."""
+    quirk_cache = QuirkCache()
+
     def _encode(self, obj, context, path):
         """Encrypt the given payload with the token stored in the context.
 
         :param obj: JSON object to encrypt"""
         # pp(context)
-        return Utils.encrypt(json.dumps(obj).encode('utf-8') + b'\x00',
-                             context['_']['token'])
+        return EncryptionAdapter.encrypt_payload(obj, context['_']['token'])
 
     def _decode(self, obj, context, path):
         """Decrypts the given payload with the token stored in the context.
 
         :return str: JSON object"""
+        # pp(context)
+        return EncryptionAdapter.decrypt_payload(obj, context['_'].get('token'),
+                                                 context['_'].get('device_id'))
+
+    @staticmethod
+    def encrypt_payload(obj, token: bytes) -> bytes:
+        """Serialize the given JSON object and encrypt it with the token."""
+        return Utils.encrypt(_json_backend.dumps(obj) + b'\x00', token)
+
+    @staticmethod
+    def decrypt_payload(data: bytes, token: bytes,
+                        device_id: bytes = None) -> Any:
+        """Decrypt the given payload and deserialize it as JSON.
+
+        :param bytes data: Encrypted payload
+        :param bytes token: Token to use
+        :param bytes device_id: Device id used to look up the needed quirk
+        :return: JSON object, raw bytes if the decryption fails"""
         try:
-            # pp(context)
-            decrypted = Utils.decrypt(obj, context['_']['token'])
+            decrypted = Utils.decrypt(data, token)
             decrypted = decrypted.rstrip(b"\x00")
         except Exception:
-            _LOGGER.debug("Unable to decrypt, returning raw bytes: %s", obj)
-            return obj
-
-        # list of adaption functions for malformed json payload (quirks)
-        decrypted_quirks = [
-            # try without modifications first
-            lambda decrypted_bytes: decrypted_bytes,
-            # powerstrip returns malformed JSON if the device is not
-            # connected to the cloud, so we try to fix it here carefully.
-            lambda decrypted_bytes: decrypted_bytes.replace(b',,"otu_stat"', b',"otu_stat"'),
-            # xiaomi cloud returns malformed json when answering _sync.batch_gen_room_up_url
-            # command so try to sanitize it
-            lambda decrypted_bytes:
-                decrypted_bytes[:decrypted_bytes.rfind(b'\x00')]
-                if b'\x00' in decrypted_bytes
-                else decrypted_bytes
-        ]
-
-        for i, quirk in enumerate(decrypted_quirks):
-            decoded = quirk(decrypted).decode('utf-8')
+            _LOGGER.debug("Unable to decrypt, returning raw bytes: %s", data)
+            return data
+
+        quirks = EncryptionAdapter.quirk_cache
+        last = len(DECRYPTED_QUIRKS) - 1
+        for i, idx in enumerate(quirks.order(device_id)):
+            name, quirk = DECRYPTED_QUIRKS[idx]
+            decoded = quirk(decrypted)
             try:
-                return json.loads(decoded)
+                result = _json_backend.loads(decoded)
             except Exception as ex:
                 # log the error when decrypted bytes couldn't be loaded
                 # after trying all quirk adaptions
-                if i == len(decrypted_quirks) - 1:
-                    _LOGGER.error("unable to parse json '%s': %s", decoded, ex)
+                if i == last:
+                    quirks.failed()
+                    _LOGGER.error("unable to parse json %r: %s", decoded, ex)
+            else:
+                quirks.learn(device_id, idx)
+                return result
 
         return None
 
@@ -203,3 +409,204 @@ Message = Struct(
                  Utils.md5,
                  Utils.checksum_field_bytes)),
 )
+
+
+class MessageCodec:
+    """Fast-path encoder and decoder for miIO frames.
+
+    This produces and consumes the same frames as :data:`Message`,
+    but handles the fixed 32-byte header directly with :mod:`struct`
+    instead of going through the construct machinery.
+    The parsed frames are containers structured like the ones
+    returned by :data:`Message`."""
+
+    HEADER = struct.Struct(">HHI4sI16s")
+    MAGIC = 0x2131
+    HEADER_LENGTH = 32
+
+    @staticmethod
+    def build(device_id: bytes, ts: Union[datetime.datetime, int],
+              payload: Any, token: bytes) -> bytes:
+        """Build a frame for the given payload.
+
+        :param bytes device_id: Device id as received in the handshake
+        :param ts: Timestamp, either a datetime or an unix timestamp
+        :param payload: JSON object to send
+        :param bytes token: Token to use
+        :return: Frame to send"""
+        return HeaderTemplate(device_id, token).build(ts, payload)
+
+    @staticmethod
+    def parse(buf: bytes, token: bytes = None,
+              lazy: bool = False) -> Union[Container, 'LazyMessage']:
+        """Parse a frame, verifying its checksum unless it is a hello.
+
+        With `lazy` set, the header and checksum are still validated,
+        but the payload is only decrypted when accessed, see :class:`LazyMessage`.
+
+        :param buf: Received frame
+        :param bytes token: Token to use, not needed for hellos
+        :param bool lazy: Defer the decryption of the payload
+        :raises ChecksumError: if the checksum does not match"""
+        view = memoryview(buf)
+        if len(view) < MessageCodec.HEADER_LENGTH:
+            raise StreamError("frame too short: %s bytes" % len(view))
+        magic, length, unknown, device_id, ts, checksum = \
+            MessageCodec.HEADER.unpack_from(view)
+        if magic != MessageCodec.MAGIC:
+            raise ConstError("parsing expected %s but parsed %s" % (
+                MessageCodec.MAGIC, magic))
+
+        data = view[MessageCodec.HEADER_LENGTH:]
+        if length != MessageCodec.HEADER_LENGTH:
+            Utils.verify_token(token)
+            computed = hashlib.md5(view[:16])
+            computed.update(token)
+            computed.update(data)
+            computed = computed.digest()
+            if checksum != computed:
+                raise ChecksumError("wrong checksum, read %r, computed %r" % (
+                    checksum.hex(), computed.hex()))
+
+        data = data.tobytes()
+        if lazy:
+            return LazyMessage(view[:16].tobytes(), length, unknown, device_id,
+                               ts, checksum, data, token)
+
+        return Container(
+            data=Container(
+                data=data,
+                value=EncryptionAdapter.decrypt_payload(data, token,
+                                                        device_id),
+                offset1=MessageCodec.HEADER_LENGTH,
+                offset2=len(view),
+                length=len(data)),
+            header=MessageCodec._header_container(
+                view[:16].tobytes(), length, unknown, device_id, ts),
+            checksum=checksum)
+
+    @staticmethod
+    def _header_container(raw: bytes, length: int, unknown: int,
+                          device_id: bytes, ts: int) -> Container:
+        """Return a header container as parsed by :data:`Message`."""
+        return Container(
+            data=raw,
+            value=Container(
+                length=length,
+                unknown=unknown,
+                device_id=device_id,
+                ts=datetime.datetime.utcfromtimestamp(ts)),
+            offset1=0,
+            offset2=16,
+            length=16)
+
+
+class LazyPayload:
+    """Encrypted payload of a frame, decrypted on first access of `value`."""
+    def __init__(self, data: bytes, token: bytes,
+                 device_id: bytes = None) -> None:
+        self.data = data
+        self._token = token
+        self._device_id = device_id
+        self._decrypted = False
+        self._value = None  # type: Any
+
+    @property
+    def value(self) -> Any:
+        """Decrypted JSON object, or raw bytes if the decryption failed."""
+        if not self._decrypted:
+            self._value = EncryptionAdapter.decrypt_payload(
+                self.data, self._token, self._device_id)
+            self._decrypted = True
+        return self._value
+
+    @property
+    def decrypted(self) -> bool:
+        """True if the payload has already been decrypted."""
+        return self._decrypted
+
+    def __repr__(self):
+        if self._decrypted:
+            return "<LazyPayload value=%r>" % self._value
+        return "<LazyPayload %s encrypted bytes>" % len(self.data)
+
+
+class LazyMessage:
+    """Frame parsed by :func:`MessageCodec.parse` with ``lazy=True``.
+
+    The header and the checksum have been validated, the payload is
+    decrypted only when :attr:`payload` (or ``data.value``) is accessed.
+    Attribute access is compatible with the containers returned by
+    :data:`Message`, so header-only consumers such as discovery or routing
+    by the device id never pay for the decryption."""
+    def __init__(self, raw_header: bytes, length: int, unknown: int,
+                 device_id: bytes, ts: int, checksum: bytes, data: bytes,
+                 token: bytes) -> None:
+        self.device_id = device_id
+        self.checksum = checksum
+        self.data = LazyPayload(data, token, device_id)
+        self._header_fields = (raw_header, length, unknown, device_id, ts)
+        self._header = None  # type: Container
+
+    @property
+    def header(self) -> Container:
+        """Header container as parsed by :data:`Message`."""
+        if self._header is None:
+            self._header = MessageCodec._header_container(*self._header_fields)
+        return self._header
+
+    @property
+    def ts(self) -> datetime.datetime:
+        """Timestamp from the header."""
+        return self.header.value.ts
+
+    @property
+    def payload(self) -> Any:
+        """Decrypted payload."""
+        return self.data.value
+
+    def __repr__(self):
+        return "<LazyMessage header=%s checksum=%s data=%r>" % (
+            self.header.value, self.checksum.hex(), self.data)
+
+
+class HeaderTemplate:
+    """Preassembled header for the frames sent to a single device.
+
+    Only the length, the timestamp and the checksum change between the
+    frames sent to a device, so the rest of the header is packed once
+    and those fields are patched into the same buffer for every frame.
+    The checksum is calculated incrementally over the header, the token
+    and the ciphertext without concatenating them first."""
+    def __init__(self, device_id: bytes, token: bytes) -> None:
+        Utils.verify_token(token)
+        self.device_id = device_id
+        self.token = token
+        self._header = bytearray(MessageCodec.HEADER_LENGTH)
+        self._view = memoryview(self._header)
+        struct.pack_into(">HHI4s", self._header, 0,
+                         MessageCodec.MAGIC, 0, 0, device_id)
+
+    def matches(self, device_id: bytes, token: bytes) -> bool:
+        """Return True if the template is valid for the device and token."""
+        return self.device_id == device_id and self.token == token
+
+    def build(self, ts: Union[datetime.datetime, int], payload: Any) -> bytes:
+        """Build a frame for the given payload.
+
+        :param ts: Timestamp, either a datetime or an unix timestamp
+        :param payload: JSON object to send
+        :return: Frame to send"""
+        if isinstance(ts, datetime.datetime):
+            ts = calendar.timegm(ts.timetuple())
+        data = EncryptionAdapter.encrypt_payload(payload, self.token)
+
+        header = self._header
+        struct.pack_into(">H", header, 2, MessageCodec.HEADER_LENGTH + len(data))
+        struct.pack_into(">I", header, 12, ts)
+        checksum = hashlib.md5(self._view[:16])
+        checksum.update(self.token)
+        checksum.update(data)
+        header[16:] = checksum.digest()
+
+        return b"".join((header, data))
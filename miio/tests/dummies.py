@@ -1,3 +1,11 @@
+import calendar
+import datetime
+import socket
+import threading
+
+from miio.protocol import MessageCodec
+
+
 class DummyDevice:
     """DummyDevice base class, you should inherit from this and call
     `super().__init__(args, kwargs)` to save the original state.
@@ -40,3 +48,81 @@ class DummyDevice:
     def _get_state(self, props):
         """Return wanted properties"""
         return [self.state[x] for x in props if x in self.state]
+
+
+class DummyUdpDevice:
+    """Local UDP stand-in for a miIO device.
+
+    Answers handshakes and commands sent to ``127.0.0.1:port`` from a
+    background thread. The result for a command is looked up from
+    `return_values` like for :class:`DummyDevice`, unknown commands are
+    answered with an error. Use it as a context manager:
+
+    .. code-block::
+        with DummyUdpDevice(token, {"get_prop": lambda x: ["on"]}) as dummy:
+            dev = Device("127.0.0.1", token.hex())
+            dev.port = dummy.port
+    """
+    def __init__(self, token: bytes, return_values=None,
+                 device_id: bytes = b'\x00\x00\x00\x2a') -> None:
+        self.token = token
+        self.device_id = device_id
+        self.return_values = return_values or {}
+        self.responding = True
+        self.clients = set()
+        self.requests = []
+        self.hellos = 0
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.settimeout(0.05)
+        self.port = self._sock.getsockname()[1]
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stopped.set()
+        self._thread.join()
+        self._sock.close()
+
+    @property
+    def ts(self) -> int:
+        return calendar.timegm(datetime.datetime.utcnow().timetuple())
+
+    def reply(self, request):
+        """Build the response for a parsed request."""
+        method = request["method"]
+        if method not in self.return_values:
+            return {"id": request["id"],
+                    "error": {"code": -1, "message": "unknown method"}}
+        return {"id": request["id"],
+                "result": self.return_values[method](request.get("params"))}
+
+    def _serve(self):
+        while not self._stopped.is_set():
+            try:
+                data, addr = self._sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            self.clients.add(addr)
+            if not self.responding:
+                continue
+
+            if len(data) == 32:
+                self.hellos += 1
+                hello = MessageCodec.HEADER.pack(
+                    MessageCodec.MAGIC, 32, 0, self.device_id, self.ts,
+                    self.token)
+                self._sock.sendto(hello, addr)
+                continue
+
+            request = MessageCodec.parse(data, self.token).data.value
+            self.requests.append(request)
+            response = self.reply(request)
+            if response is not None:
+                self._sock.sendto(MessageCodec.build(
+                    self.device_id, self.ts, response, self.token), addr)
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from miio import Device, DeviceException
+from miio.exceptions import DeviceError
+from .dummies import DummyUdpDevice
+
+
+@pytest.fixture
+def token():
+    return os.urandom(16)
+
+
+@pytest.fixture
+def dummy(token):
+    return_values = {
+        "get_prop": lambda props: ["on" for _ in props],
+        "set_power": lambda params: ["ok"],
+    }
+    with DummyUdpDevice(token, return_values) as dummy:
+        yield dummy
+
+
+def create_device(token, dummy, **kwargs):
+    dev = Device("127.0.0.1", token.hex(), **kwargs)
+    dev.port = dummy.port
+    dev._timeout = 0.2
+    return dev
+
+
+@pytest.mark.parametrize("fast_codec", [False, True])
+def test_send(token, dummy, fast_codec):
+    with create_device(token, dummy, fast_codec=fast_codec) as dev:
+        assert dev.send("get_prop", ["power", "mode"]) == ["on", "on"]
+        assert dev.send("set_power", ["off"]) == ["ok"]
+        with pytest.raises(DeviceError):
+            dev.send("unknown")
+
+    assert dummy.hellos == 1
+    assert [r["method"] for r in dummy.requests] == [
+        "get_prop", "set_power", "unknown"]
+
+
+def test_socket_is_reused(token, dummy):
+    dev = create_device(token, dummy)
+    dev.send("get_prop", ["power"])
+    fileno = dev._socket.fileno()
+    for _ in range(10):
+        dev.send("get_prop", ["power"])
+        assert dev._socket.fileno() == fileno
+
+    # handshake and all commands from the same source port
+    assert len(dummy.clients) == 1
+
+    dev.close()
+    assert dev._socket is None
+    dev.close()
+
+
+def test_context_manager_closes_socket(token, dummy):
+    with create_device(token, dummy) as dev:
+        dev.send("get_prop", ["power"])
+        sock = dev._socket
+    assert dev._socket is None
+    assert sock.fileno() == -1
+
+
+def test_socket_recreated_after_error(token, dummy):
+    dev = create_device(token, dummy)
+    dev.send("get_prop", ["power"])
+    sock = dev._socket
+
+    dummy.responding = False
+    with pytest.raises(DeviceException):
+        dev.send("get_prop", ["power"], retry_count=0)
+    assert dev._socket is None
+    assert sock.fileno() == -1
+
+    dummy.responding = True
+    assert dev.send("get_prop", ["power"]) == ["on"]
+    assert dev._socket is not None
+    assert len(dummy.clients) == 2
+    dev.close()
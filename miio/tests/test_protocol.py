@@ -1,8 +1,16 @@
 import binascii
+import datetime
+import os
 from unittest import TestCase
+from unittest.mock import patch
+
+import pytest
+from construct.core import ChecksumError, ConstError, StreamError
 
 from .. import Utils
-from ..protocol import Message
+from .. import protocol
+from ..protocol import (EncryptionAdapter, HeaderTemplate, LazyMessage, Message,
+                        MessageCodec, QuirkCache, )
 
 
 class TestProtocol(TestCase):
@@ -22,6 +30,22 @@ class TestProtocol(TestCase):
         decrypted = Utils.decrypt(encrypted, token)
         assert payload == decrypted
 
+    def test_cipher_cache(self):
+        token = bytes.fromhex(32 * '0')
+        other_token = bytes.fromhex(32 * '1')
+
+        Utils.cipher.cache_clear()
+        assert Utils.cipher(token) is Utils.cipher(token)
+        assert Utils.cipher(token) is not Utils.cipher(other_token)
+        assert Utils.cipher.cache_info().misses == 2
+
+        payload = b"hello world"
+        for _ in range(3):
+            encrypted = Utils.encrypt(payload, token)
+            assert Utils.decrypt(encrypted, token) == payload
+        assert Utils.encrypt(payload, token) != Utils.encrypt(payload, other_token)
+        assert Utils.cipher.cache_info().misses == 2
+
     def test_invalid_token(self):
         payload = b"hello world"
         wrong_type = 1234
@@ -77,3 +101,227 @@ class TestProtocol(TestCase):
         assert parsed_msg.data.value
         assert isinstance(parsed_msg.data.value, dict)
         assert parsed_msg.data.value['id'] == 123456
+
+
+def build_with_message(device_id, ts, payload, token):
+    header = {'length': 0, 'unknown': 0x00000000,
+              'device_id': device_id, 'ts': ts}
+    msg = {'data': {'value': payload},
+           'header': {'value': header},
+           'checksum': 0}
+    return Message.build(msg, token=token)
+
+
+CODEC_PAYLOADS = [
+    {"id": 1, "method": "miIO.info", "params": []},
+    {"id": 9998, "method": "get_prop", "params": ["power", "aqi", "mode"]},
+    {"id": 123, "result": ["on", 10, "auto", None, 12.5]},
+    {"id": 4, "result": [{"msg_ver": 2, "state": 8, "battery": 100,
+                          "clean_area": 140000, "name": "ä" * 700}]},
+    {"id": 5, "error": {"code": -5001, "message": "invalid_arg"}},
+]
+
+
+@pytest.mark.parametrize("payload", CODEC_PAYLOADS)
+def test_codec_build_matches_message(payload):
+    token = os.urandom(16)
+    device_id = os.urandom(4)
+    ts = datetime.datetime(2018, 7, 19, 14, 33, 7)
+
+    expected = build_with_message(device_id, ts, payload, token)
+    assert MessageCodec.build(device_id, ts, payload, token) == expected
+    unix_ts = int((ts - datetime.datetime(1970, 1, 1)).total_seconds())
+    assert MessageCodec.build(device_id, unix_ts, payload, token) == expected
+
+
+@pytest.mark.parametrize("payload", CODEC_PAYLOADS)
+def test_codec_parse_matches_message(payload):
+    token = os.urandom(16)
+    device_id = os.urandom(4)
+    ts = datetime.datetime(2018, 7, 19, 14, 33, 7)
+
+    frame = build_with_message(device_id, ts, payload, token)
+    expected = Message.parse(frame, token=token)
+    parsed = MessageCodec.parse(frame, token)
+    assert parsed == expected
+    assert parsed.data.value == payload
+    assert parsed.header.value.device_id == device_id
+    assert parsed.header.value.ts == ts
+
+    assert MessageCodec.parse(bytearray(frame), token) == expected
+    assert MessageCodec.parse(memoryview(frame), token) == expected
+
+
+def test_header_template():
+    token = os.urandom(16)
+    device_id = os.urandom(4)
+    template = HeaderTemplate(device_id, token)
+    assert template.matches(device_id, token)
+    assert not template.matches(device_id, os.urandom(16))
+
+    ts = datetime.datetime(2018, 7, 19, 14, 33, 7)
+    # lengths and timestamps change between the frames
+    for i, payload in enumerate(CODEC_PAYLOADS * 2):
+        send_ts = ts + datetime.timedelta(seconds=i)
+        expected = build_with_message(device_id, send_ts, payload, token)
+        assert template.build(send_ts, payload) == expected
+
+    with pytest.raises(ValueError):
+        HeaderTemplate(device_id, token[:8])
+
+
+def test_codec_parse_hello():
+    hello = bytes.fromhex(
+        '21310020ffffffffffffffffffffffffffffffffffffffffffffffffffffffff')
+    assert MessageCodec.parse(hello) == Message.parse(hello)
+
+    reply = bytes.fromhex('2131002000000000034d57ec5b50a0c9') + os.urandom(16)
+    assert MessageCodec.parse(reply) == Message.parse(reply)
+    assert MessageCodec.parse(reply).checksum == reply[16:]
+
+
+def test_codec_parse_errors():
+    token = os.urandom(16)
+    frame = MessageCodec.build(b'\x00\x00\x00\x01', 0, {"id": 1}, token)
+
+    with pytest.raises(ChecksumError):
+        MessageCodec.parse(frame, os.urandom(16))
+    with pytest.raises(ChecksumError):
+        Message.parse(frame[:-1] + b'\x00', token=token)
+    with pytest.raises(ChecksumError):
+        MessageCodec.parse(frame[:-1] + b'\x00', token)
+    with pytest.raises(ConstError):
+        MessageCodec.parse(b'\x00' + frame[1:], token)
+    with pytest.raises(StreamError):
+        MessageCodec.parse(frame[:20], token)
+
+
+def test_codec_parse_lazy():
+    token = os.urandom(16)
+    device_id = os.urandom(4)
+    ts = datetime.datetime(2018, 7, 19, 14, 33, 7)
+    payload = CODEC_PAYLOADS[1]
+    frame = MessageCodec.build(device_id, ts, payload, token)
+
+    with patch.object(EncryptionAdapter, "decrypt_payload",
+                      wraps=EncryptionAdapter.decrypt_payload) as decrypt:
+        parsed = MessageCodec.parse(frame, token, lazy=True)
+        assert isinstance(parsed, LazyMessage)
+        assert parsed.device_id == device_id
+        assert parsed.ts == ts
+        assert parsed.checksum == frame[16:32]
+        assert not parsed.data.decrypted
+        decrypt.assert_not_called()
+
+        assert parsed.payload == payload
+        assert parsed.data.value == payload
+        assert parsed.data.decrypted
+        decrypt.assert_called_once_with(frame[32:], token, device_id)
+
+    assert parsed.header == Message.parse(frame, token=token).header
+
+    with pytest.raises(ChecksumError):
+        MessageCodec.parse(frame, os.urandom(16), lazy=True)
+
+
+def test_quirk_cache():
+    token = os.urandom(16)
+    powerstrip = b'\x00\x00\x00\x01'
+    other = b'\x00\x00\x00\x02'
+    malformed = b'{"id": 1, "result": ["on"],,"otu_stat":0}'
+    encrypted = Utils.encrypt(malformed, token)
+
+    quirks = QuirkCache(maxsize=2)
+    with patch.object(EncryptionAdapter, "quirk_cache", quirks):
+        assert quirks.quirk_for(powerstrip) == "none"
+        for _ in range(3):
+            decoded = EncryptionAdapter.decrypt_payload(encrypted, token,
+                                                        powerstrip)
+            assert decoded["otu_stat"] == 0
+            assert quirks.quirk_for(powerstrip) == "otu_stat"
+        assert quirks.order(powerstrip)[0] == 1
+        assert quirks.order(other)[0] == 0
+        assert quirks.stats["otu_stat"] == 3
+
+        # well-formed payloads are not stored
+        valid = Utils.encrypt(b'{"id": 2}', token)
+        assert EncryptionAdapter.decrypt_payload(valid, token, other) == {"id": 2}
+        assert len(quirks) == 1
+        assert quirks.stats["none"] == 1
+
+        # the table is bounded
+        for i in range(3, 6):
+            EncryptionAdapter.decrypt_payload(encrypted, token,
+                                              i.to_bytes(4, "big"))
+        assert len(quirks) == 2
+        assert quirks.quirk_for(powerstrip) == "none"
+
+        garbage = Utils.encrypt(b'{"id": ', token)
+        assert EncryptionAdapter.decrypt_payload(garbage, token, other) is None
+        assert quirks.stats["failed"] == 1
+
+        # the device id is taken from the parse context or the header
+        frame = MessageCodec.build(powerstrip, 0, {}, token)
+        frame = frame[:32] + encrypted
+        checksum = Utils.md5(frame[:16] + token + encrypted)
+        frame = frame[:16] + checksum + encrypted
+        Message.parse(frame, token=token, device_id=powerstrip)
+        assert quirks.quirk_for(powerstrip) == "otu_stat"
+        quirks.clear()
+        MessageCodec.parse(frame, token)
+        assert quirks.quirk_for(powerstrip) == "otu_stat"
+
+
+@pytest.fixture(params=list(protocol.JSON_BACKENDS))
+def json_backend(request):
+    previous = protocol.get_json_backend()
+    try:
+        backend = protocol.set_json_backend(request.param)
+    except ImportError:
+        pytest.skip("%s is not installed" % request.param)
+    yield backend
+    protocol._json_backend = previous
+
+
+def test_json_backend_quirks(json_backend):
+    token = os.urandom(16)
+    cases = [
+        (b'{"id": 123456}', {"id": 123456}),
+        (b'{"id": 123456,,"otu_stat":0}', {"id": 123456, "otu_stat": 0}),
+        (b'{"id": 123456}\x00k', {"id": 123456}),
+        (b'{"id": 1, "result": ["\xc3\xa4", 1.5, null, true]}',
+         {"id": 1, "result": ["\u00e4", 1.5, None, True]}),
+    ]
+    for data, expected in cases:
+        encrypted = Utils.encrypt(data, token)
+        assert EncryptionAdapter.decrypt_payload(encrypted, token) == expected
+
+
+def test_json_backend_roundtrip(json_backend):
+    token = os.urandom(16)
+    for payload in CODEC_PAYLOADS:
+        encrypted = EncryptionAdapter.encrypt_payload(payload, token)
+        assert Utils.decrypt(encrypted, token).endswith(b'\x00')
+        assert EncryptionAdapter.decrypt_payload(encrypted, token) == payload
+
+        frame = MessageCodec.build(b'\x00\x00\x00\x01', 0, payload, token)
+        assert frame == build_with_message(
+            b'\x00\x00\x00\x01', datetime.datetime(1970, 1, 1), payload, token)
+        assert MessageCodec.parse(frame, token).data.value == payload
+
+    assert json_backend.loads(json_backend.dumps({1: "/", "a": [1]})) == \
+        {"1": "/", "a": [1]}
+    assert json_backend.loads(json_backend.dumps({"a": [1]}, indent=2)) == \
+        {"a": [1]}
+
+
+def test_set_json_backend():
+    previous = protocol.get_json_backend()
+    try:
+        assert protocol.set_json_backend("json").name == "json"
+        assert isinstance(protocol.get_json_backend(), protocol.JsonBackend)
+        assert protocol.set_json_backend().name in protocol.JSON_BACKENDS
+        with pytest.raises(ValueError):
+            protocol.set_json_backend("simplejson")
+    finally:
+        protocol._json_backend = previous